@@ -0,0 +1,9 @@
+import multiprocessing
+import os
+
+# The gevent worker monkey-patches the stdlib before main.py is imported,
+# so requests/redis calls yield instead of blocking the whole worker.
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_connections = 200
+keepalive = 30
@@ -1,59 +1,174 @@
 from flask import Flask, redirect, request, session, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_session import Session
+import orjson
+import redis
 import requests
+import http.cookiejar
 import urllib.parse
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
 import os
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from dotenv import load_dotenv
 
 load_dotenv()
 
+
+class ORJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        # Dates go through Flask's default (HTTP date) like the stock provider.
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            # orjson only supports two-space indentation.
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=kwargs.get("default", self.default), option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 SESSION_COOKIE_NAME = "spotify_session"
 app.config['SESSION_COOKIE_SAMESITE'] = 'None'
 app.config['SESSION_COOKIE_SECURE'] = True  
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "dev_secret_key")
-app.config['SESSION_TYPE'] = 'filesystem'
+app.config['SESSION_TYPE'] = 'redis'
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379")
+# Heroku Redis serves rediss:// with a self-signed certificate. Plain
+# connections reject the ssl_* kwargs, so only pass it for TLS URLs.
+_REDIS_SSL = {'ssl_cert_reqs': None} if REDIS_URL.startswith('rediss://') else {}
+# Blocking pool: with many gevent greenlets per worker, callers wait for a free
+# connection instead of failing with "Too many connections".
+app.config['SESSION_REDIS'] = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+    REDIS_URL,
+    max_connections=32,
+    timeout=5,
+    socket_keepalive=True,
+    **_REDIS_SSL,
+))
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
 Session(app)
 
-CORS(app, supports_credentials=True, origins=[os.environ.get("FRONTEND_URL")])
+FRONTEND_URL = os.environ.get("FRONTEND_URL")
+CORS(app, supports_credentials=True, origins=[FRONTEND_URL])
 
 CLIENT_ID = os.environ.get("SPOTIFY_CLIENT_ID")
 CLIENT_SECRET = os.environ.get("SPOTIFY_CLIENT_SECRET")
 REDIRECT_URI = os.environ.get("REDIRECT_URI")
 AUTH_URL = 'https://accounts.spotify.com/authorize'
 TOKEN_URL = 'https://accounts.spotify.com/api/token'
+SCOPE = (
+    'playlist-modify-public playlist-modify-private playlist-read-private '
+    'user-read-playback-state user-modify-playback-state user-read-currently-playing '
+    'user-read-recently-played user-top-read'
+)
+_LOGIN_PARAMS = {
+    'client_id': CLIENT_ID,
+    'response_type': 'code',
+    'scope': SCOPE,
+    'redirect_uri': REDIRECT_URI,
+    'show_dialog': True,
+    'prompt': 'consent'
+}
+LOGIN_URL = f"{AUTH_URL}?{urllib.parse.urlencode(_LOGIN_PARAMS)}"
+
+# Seconds to wait on connect/read for any Spotify call.
+SPOTIFY_TIMEOUT = 10
+# Longest Retry-After we will wait out; anything longer is returned to the caller.
+MAX_RETRY_AFTER = 5
+
+
+class CappedRetry(Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        # Retrying inside a longer rate-limit window just earns another 429,
+        # so give up and let the caller see the response.
+        if response is not None and (self.get_retry_after(response) or 0) > MAX_RETRY_AFTER:
+            raise MaxRetryError(_pool, url, "Retry-After exceeds MAX_RETRY_AFTER")
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+# Shared keep-alive pool for accounts.spotify.com / api.spotify.com.
+# Only GETs are retried so a flaky 5xx can't create a playlist twice.
+SPOTIFY = requests.Session()
+# The session is shared by every user; never carry cookies from one user's call to another's.
+SPOTIFY.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+SPOTIFY.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=CappedRetry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False,
+    ),
+))
+
+# Treat tokens as expired this many seconds early so in-flight calls don't race expiry.
+TOKEN_EXPIRY_SKEW = 60
+
+# How long a rejected refresh token is remembered before trying Spotify again.
+FAILED_REFRESH_TTL = 3600
+
+# session id -> time.monotonic() until which refreshing is skipped
+_FAILED_REFRESH: dict[str, float] = {}
 
 
 def get_access_token():
     if 'access_token' not in session:
         return None
-    if datetime.now().timestamp() > session.get('expires_at', 0):
+    now = time.time()
+    if now + TOKEN_EXPIRY_SKEW > session.get('expires_at', 0):
+        token = refresh_access_token()
+        if token:
+            return token
+        # An early refresh failed but the current token still works; keep using it.
+        if now < session.get('expires_at', 0):
+            return session['access_token']
         if 'refresh_token' not in session:
             session.pop('access_token', None)
             session.pop('expires_at', None)
-            return None
-        return refresh_access_token()
+        return None
     return session['access_token']
 
 
 def refresh_access_token():
     if 'refresh_token' not in session:
         return None
+    if (until := _FAILED_REFRESH.get(session.sid)) is not None:
+        if until > time.monotonic():
+            return None
+        del _FAILED_REFRESH[session.sid]
     req_body = {
         'grant_type': 'refresh_token',
         'refresh_token': session['refresh_token'],
         'client_id': CLIENT_ID,
         'client_secret': CLIENT_SECRET
     }
-    response = requests.post(TOKEN_URL, data=req_body)
-    new_token_info = response.json()
+    response = SPOTIFY.post(TOKEN_URL, data=req_body, timeout=SPOTIFY_TIMEOUT)
+    new_token_info = orjson.loads(response.content)
     if 'access_token' not in new_token_info:
+        # 400 means the refresh token itself was rejected (e.g. revoked);
+        # other failures may be transient and are retried on the next call.
+        if response.status_code == 400:
+            now = time.monotonic()
+            # Drop entries for sessions that never came back so the map stays bounded.
+            for sid in [sid for sid, until in _FAILED_REFRESH.items() if until <= now]:
+                del _FAILED_REFRESH[sid]
+            _FAILED_REFRESH[session.sid] = now + FAILED_REFRESH_TTL
         return None
+    expires_in = new_token_info.get('expires_in', 3600)
     session['access_token'] = new_token_info['access_token']
-    session['expires_at'] = datetime.now().timestamp() + new_token_info.get('expires_in', 3600)
+    session['expires_at'] = time.time() + expires_in
     session.modified = True
     return session['access_token']
 
@@ -65,21 +180,7 @@ def home():
 
 @app.route("/login")
 def login():
-    scope = (
-        'playlist-modify-public playlist-modify-private playlist-read-private '
-        'user-read-playback-state user-modify-playback-state user-read-currently-playing '
-        'user-read-recently-played user-top-read'
-    )
-    params = {
-        'client_id': CLIENT_ID,
-        'response_type': 'code',
-        'scope': scope,
-        'redirect_uri': REDIRECT_URI,
-        'show_dialog': True,
-        'prompt': 'consent'
-    }
-    auth_url = f"{AUTH_URL}?{urllib.parse.urlencode(params)}"
-    return redirect(auth_url)
+    return redirect(LOGIN_URL)
 
 
 @app.route("/callback")
@@ -95,23 +196,39 @@ def callback():
         'client_id': CLIENT_ID,
         'client_secret': CLIENT_SECRET
     }
-    response = requests.post(TOKEN_URL, data=req_body)
-    token_data = response.json()
+    response = SPOTIFY.post(TOKEN_URL, data=req_body, timeout=SPOTIFY_TIMEOUT)
+    token_data = orjson.loads(response.content)
     if 'access_token' not in token_data:
         return jsonify({"error": "Failed to get access token", "details": token_data}), 400
 
+    _FAILED_REFRESH.pop(session.sid, None)
     session['access_token'] = token_data['access_token']
-    session['expires_at'] = datetime.now().timestamp() + token_data['expires_in']
+    session['expires_at'] = time.time() + token_data['expires_in']
     if 'refresh_token' in token_data:
         session['refresh_token'] = token_data['refresh_token']
 
-    return redirect(os.environ.get("FRONTEND_URL") + "/dashboard")
+    # The profile id doesn't change within a session; remember it so /playlist can skip /me.
+    session.pop('user_id', None)
+    # Best effort only: /playlist looks the id up itself when it is missing.
+    try:
+        me_resp = SPOTIFY.get("https://api.spotify.com/v1/me", headers={"Authorization": f"Bearer {token_data['access_token']}"}, timeout=SPOTIFY_TIMEOUT)
+    except requests.RequestException:
+        me_resp = None
+    if me_resp is not None and me_resp.status_code == 200:
+        session['user_id'] = orjson.loads(me_resp.content).get("id")
+
+    return redirect(FRONTEND_URL + "/dashboard")
 
 
 @app.route("/refresh-token")
 def refresh_token_route():
+    if session.get('expires_at', 0) - time.time() > TOKEN_EXPIRY_SKEW:
+        return jsonify({"message": "Token still valid"})
     token = refresh_access_token()
     if not token:
+        # Same fallback as get_access_token: an early refresh failed but the token still works.
+        if time.time() < session.get('expires_at', 0):
+            return jsonify({"message": "Token still valid"})
         return jsonify({"error": "Failed to refresh token"}), 401
     return jsonify({"message": "Token refreshed successfully"})
 
@@ -122,8 +239,8 @@ def me():
     if not access_token:
         return jsonify({"error": "Unauthorized"}), 401
     headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get("https://api.spotify.com/v1/me", headers=headers)
-    return jsonify(response.json())
+    response = SPOTIFY.get("https://api.spotify.com/v1/me", headers=headers, timeout=SPOTIFY_TIMEOUT)
+    return jsonify(orjson.loads(response.content))
 
 
 @app.route("/history/top-tracks")
@@ -133,8 +250,8 @@ def top_tracks():
         return jsonify({"error": "Unauthorized"}), 401
     headers = {"Authorization": f"Bearer {access_token}"}
     params = {"limit": 5, "time_range": "short_term"}
-    r = requests.get("https://api.spotify.com/v1/me/top/tracks", headers=headers, params=params)
-    return jsonify(r.json())
+    r = SPOTIFY.get("https://api.spotify.com/v1/me/top/tracks", headers=headers, params=params, timeout=SPOTIFY_TIMEOUT)
+    return jsonify(orjson.loads(r.content))
 
 
 @app.route("/history/recent-tracks")
@@ -143,10 +260,10 @@ def recent_tracks():
     if not access_token:
         return jsonify({"error": "Unauthorized"}), 401
     headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get("https://api.spotify.com/v1/me/player/recently-played?limit=5", headers=headers)
+    response = SPOTIFY.get("https://api.spotify.com/v1/me/player/recently-played?limit=5", headers=headers, timeout=SPOTIFY_TIMEOUT)
     if response.status_code != 200:
         return jsonify({"error": "Unable to fetch data"}), response.status_code
-    data = response.json()
+    data = orjson.loads(response.content)
     tracks = [{
         "name": item["track"]["name"],
         "artists": [a["name"] for a in item["track"]["artists"]],
@@ -167,43 +284,43 @@ def create_playlist():
         return jsonify({"error": "Unauthorized"}), 401
 
     headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    me_resp = requests.get("https://api.spotify.com/v1/me", headers=headers)
-    if me_resp.status_code != 200:
-        return jsonify({"error": "Failed to get user profile"}), me_resp.status_code
-    me = me_resp.json()
-    user_id = me.get("id")
-
-    top_tracks_resp = requests.get("https://api.spotify.com/v1/me/top/tracks?limit=20", headers=headers)
-    top_tracks_list = top_tracks_resp.json().get("items", []) if top_tracks_resp.status_code == 200 else []
-
-    recent_resp = requests.get("https://api.spotify.com/v1/me/player/recently-played?limit=20", headers=headers)
-    recent_tracks_list = [it["track"] for it in recent_resp.json().get("items", []) if "track" in it] if recent_resp.status_code == 200 else []
+    user_id = session.get('user_id')
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        f_me = None if user_id else ex.submit(SPOTIFY.get, "https://api.spotify.com/v1/me", headers=headers, timeout=SPOTIFY_TIMEOUT)
+        f_top = ex.submit(SPOTIFY.get, "https://api.spotify.com/v1/me/top/tracks?limit=20", headers=headers, timeout=SPOTIFY_TIMEOUT)
+        f_recent = ex.submit(SPOTIFY.get, "https://api.spotify.com/v1/me/player/recently-played?limit=20", headers=headers, timeout=SPOTIFY_TIMEOUT)
+    top_tracks_resp, recent_resp = f_top.result(), f_recent.result()
+
+    if f_me is not None:
+        me_resp = f_me.result()
+        if me_resp.status_code != 200:
+            return jsonify({"error": "Failed to get user profile"}), me_resp.status_code
+        me = orjson.loads(me_resp.content)
+        user_id = me.get("id")
+        session['user_id'] = user_id
+
+    top_tracks_list = orjson.loads(top_tracks_resp.content).get("items", []) if top_tracks_resp.status_code == 200 else []
+    recent_tracks_list = [it["track"] for it in orjson.loads(recent_resp.content).get("items", []) if "track" in it] if recent_resp.status_code == 200 else []
 
     candidate_tracks = top_tracks_list or recent_tracks_list
     if not candidate_tracks:
         return jsonify({"error": "No tracks available to generate a playlist"}), 400
 
-    unique = []
-    seen = set()
-    for tr in candidate_tracks:
-        if tr["id"] not in seen:
-            unique.append(tr)
-            seen.add(tr["id"])
-        if len(unique) >= 30:
-            break
+    unique = list({tr["id"]: tr for tr in candidate_tracks}.values())[:30]
 
     uris = [t["uri"] for t in unique]
     playlist_info = {"name": "SpinSync Playlist", "description": "A playlist made for you!", "public": False}
-    pl_resp = requests.post(f"https://api.spotify.com/v1/users/{user_id}/playlists", headers=headers, json=playlist_info)
+    pl_resp = SPOTIFY.post(f"https://api.spotify.com/v1/users/{user_id}/playlists", headers=headers, json=playlist_info, timeout=SPOTIFY_TIMEOUT)
     if pl_resp.status_code != 201:
         return jsonify({"error": "Failed to create playlist"}), pl_resp.status_code
 
-    playlist_id = pl_resp.json().get("id")
-    add_resp = requests.post(f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks", headers=headers, json={"uris": uris})
+    playlist = orjson.loads(pl_resp.content)
+    playlist_id = playlist.get("id")
+    add_resp = SPOTIFY.post(f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks", headers=headers, json={"uris": uris}, timeout=SPOTIFY_TIMEOUT)
     if add_resp.status_code != 201:
         return jsonify({"error": "Failed to add tracks"}), add_resp.status_code
 
-    playlist_url = pl_resp.json().get("external_urls", {}).get("spotify")
+    playlist_url = playlist.get("external_urls", {}).get("spotify")
     return jsonify({"message": "Playlist created!", "playlist_url": playlist_url})
 
 